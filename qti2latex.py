@@ -1,10 +1,21 @@
+import functools
+import io
+import os
 import random
 import re
 import shutil
-import tempfile
 import zipfile
-import xml.etree.ElementTree as ET
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from urllib.parse import unquote, urlsplit
+
+try:
+    # lxml's C parser is much faster on large item banks
+    import lxml.etree as ET
+    XML_PARSER_OPTIONS = dict(huge_tree=True, remove_blank_text=True, remove_comments=True, remove_pis=True)
+except ImportError:
+    import xml.etree.ElementTree as ET
+    XML_PARSER_OPTIONS = {}
 
 import click
 import pypandoc
@@ -12,24 +23,125 @@ import pypandoc
 
 essay_vspace_lines = 6
 make_answer_key = False
+# names of the media files referenced by question stems
+referenced_media = set()
+# QtiDir/QtiZip being converted, also opened in each worker process
+qti_source = None
+# parsing runs at roughly 20MB/s while starting worker processes takes up to
+# about 0.3s (spawn/forkserver), so only exports above this size are parsed
+# in parallel
+PARALLEL_PARSE_BYTES = 8 << 20
 
 # --- Minimal HTML -> LaTeX converter (safe, simple) ---
-def html_to_latex(s: str) -> str:
+def prepare_html(s: str) -> str:
     # Wrap multiline <code> blocks in <pre> so pandoc renders them as verbatim
-    s = re.sub(r'<code>([^<]*\n[^<]*)</code>', r'<pre><code>\1</code></pre>', s)
+    return re.sub(r'<code>([^<]*\n[^<]*)</code>', r'<pre><code>\1</code></pre>', s)
+
+@functools.lru_cache(maxsize=4096)
+def convert_html(s: str) -> str:
     # use pandoc to convert HTML to LaTeX
-    return pypandoc.convert_text(s, 'latex', format='html')
+    return pypandoc.convert_text(prepare_html(s), 'latex', format='html')
+
+class LatexBatcher:
+    # Collects HTML fragments so they can all be converted with one pandoc run.
+    # Each fragment is preceded by a marker paragraph that pandoc passes through
+    # untouched; the LaTeX output is split on those markers afterwards.
+    SEP = "\ue000QTISEP%d\ue000"
+    SEP_RE = re.compile("\ue000QTISEP(\\d+)\ue000")
+    # a raw text element left open swallows the following markers as escaped text
+    RAW_TEXT_RE = re.compile(r"<(/?)(script|style|textarea|title|pre)\b", re.I)
+
+    def __init__(self):
+        self.collecting = False
+        self.pending = {}
+        self.converted = {}
+
+    def add(self, s):
+        # repeated fragments ("True", "False", ...) are only converted once
+        if s not in self.converted:
+            self.pending[s] = None
+
+    @classmethod
+    def has_open_raw_text(cls, s):
+        # True when some raw text element is opened more often than closed
+        depth = {}
+        for m in cls.RAW_TEXT_RE.finditer(s):
+            tag = m.group(2).lower()
+            depth[tag] = depth.get(tag, 0) + (-1 if m.group(1) else 1)
+        return any(d > 0 for d in depth.values())
+
+    def convert(self):
+        self.collecting = False
+        fragments = list(self.pending)
+        self.pending = {}
+        batch = []
+        for s in fragments:
+            if self.has_open_raw_text(prepare_html(s)):
+                self.converted[s] = convert_html(s)
+            else:
+                batch.append(s)
+        if batch:
+            self.converted.update(zip(batch, self.convert_batch(batch)))
+
+    def convert_batch(self, fragments):
+        if len(fragments) == 1:
+            return [convert_html(fragments[0])]
+        joined = "\n\n".join(f"<p>{self.SEP % i}</p>\n\n{prepare_html(s)}" for i, s in enumerate(fragments))
+        pieces = self.SEP_RE.split(pypandoc.convert_text(joined, 'latex', format='html'))
+        # pieces is [preamble, index0, latex0, index1, latex1, ...]
+        latexes = pieces[2::2]
+        if (pieces[1::2] == [str(i) for i in range(len(fragments))]
+                and all(latex.count("\\begin{") == latex.count("\\end{")
+                        and "\\textless p\\textgreater" not in latex for latex in latexes)):
+            return [latex.strip("\n") + "\n" for latex in latexes]
+        # a fragment swallowed a marker (e.g. an unclosed <pre>), bisect so
+        # that only the offending fragments end up being converted on their own
+        half = len(fragments) // 2
+        return self.convert_batch(fragments[:half]) + self.convert_batch(fragments[half:])
+
+latex_batcher = LatexBatcher()
+
+# Short plain text (optionally in one <p>) made of characters that pandoc only
+# escapes the same way escape_tex does, e.g. "True", "42" or "<p>Option A</p>"
+PLAIN_HTML_RE = re.compile(r'(?:<p>)?([A-Za-z0-9 !"#$%&()*+,./:;=?@^_{}-]*)(?:</p>)?')
+ENTITY_RE = re.compile(r'&(?!amp;|quot;)')
+
+def plain_html_to_latex(s: str):
+    # What pandoc would produce for a plain text fragment, None for anything
+    # that needs pandoc
+    m = PLAIN_HTML_RE.fullmatch(s.strip())
+    if not m:
+        return None
+    text = m.group(1).strip()
+    if "  " in text or "--" in text or ENTITY_RE.search(text):
+        return None
+    latex = escape_tex(text.replace("&quot;", '"').replace("&amp;", "&"))
+    if len(latex) > 72:
+        # pandoc would wrap the line
+        return None
+    return latex + "\n"
+
+def html_to_latex(s: str) -> str:
+    latex = plain_html_to_latex(s)
+    if latex is not None:
+        return latex
+    if latex_batcher.collecting:
+        latex_batcher.add(s)
+        return ""
+    if s in latex_batcher.converted:
+        return latex_batcher.converted[s]
+    return convert_html(s)
+
+# single pass replacement table for escape_tex
+TEX_ESCAPES = str.maketrans({
+    "\\": "\\\\", "{": "\\{", "}": "\\}", "#": "\\#", "$": "\\$",
+    "%": "\\%", "&": "\\&", "_": "\\_", "^": "\\^{}",
+    "~": "\\~{}",
+})
 
 def escape_tex(s: str) -> str:
     # Be careful not to double-escape protected sequences like \\ from <br>
-    s = s.replace("\\", "\\\\")
-    replacements = [
-        ("{", "\\{"), ("}", "\\}"), ("#", "\\#"), ("$", "\\$"),
-        ("%", "\\%"), ("&", "\\&"), ("_", "\\_"), ("^", "\\^{}"),
-        ("~", "\\~{}"),
-    ]
-    for a, b in replacements:
-        s = s.replace(a, b)
+    s = s.translate(TEX_ESCAPES)
     # restore line breaks
     s = s.replace("\\\\\\\\\n", "\\\\\n")
     return s
@@ -42,17 +154,37 @@ NS = {
     # Canvas often omits proper ns; we'll access tags by suffix if needed
 }
 
+# tag -> localname, precomputed for the QTI namespace and filled in with any
+# other tag the first time it is seen, so it is reused across items and files
+QTI_TAGS = (
+    "questestinterop", "assessment", "section", "item", "itemmetadata", "qtimetadata",
+    "qtimetadatafield", "fieldlabel", "fieldentry", "presentation", "flow", "material",
+    "mattext", "matimage", "response_lid", "response_str", "render_choice", "render_fib",
+    "response_label", "resprocessing", "outcomes", "decvar", "respcondition",
+    "conditionvar", "and", "or", "not", "varequal", "setvar", "displayfeedback",
+    "itemfeedback", "flow_mat", "selection_ordering", "selection", "selection_number",
+    "selection_extension", "points_per_item", "title", "description",
+)
+LOCALNAMES = {f"{{{NS['qti']}}}{t}": t for t in QTI_TAGS}
+
+# read_qti_file strips the namespace from every tag while parsing, so the
+# helpers below match plain localnames (and use the C-level iter(tag)); on a
+# tree that still has namespaced tags they find nothing
+
 def findall_anyns(elem, tagname):
-    # find tags regardless of namespace by localname
-    return [n for n in elem.iter() if n.tag.split('}')[-1] == tagname]
+    # find descendant tags by localname, elem must come from read_qti_file
+    return list(elem.iter(tagname))
 
 def childall_anyns(elem, tagname):
-    # find tags regardless of namespace by localname
-    return [n for n in elem if n.tag.split('}')[-1] == tagname]
+    # find child tags by localname, elem must come from read_qti_file
+    return [n for n in elem if n.tag == tagname]
 
-def child_anyns(element, tagname):
-    c = childall_anyns(element, tagname)
-    return c[0] if c else None
+# the tags of an item that the question getters look up in its index,
+# read_qti_file bins them by localname while parsing the item
+ITEM_INDEX_TAGS = frozenset((
+    "qtimetadatafield", "presentation", "mattext", "response_lid", "response_str",
+    "resprocessing", "itemfeedback",
+))
 
 def text_of(elem):
     return (elem.text or "").strip() if elem is not None else ""
@@ -60,48 +192,134 @@ def text_of(elem):
 def first(elem_list):
     return elem_list[0] if elem_list else None
 
-def read_qti_dir(in_dir: Path):
-    # Collect all XML files except imsmanifest.xml
-    xmls = []
-    for p in in_dir.rglob("*.xml"):
-        if p.name.lower() != "imsmanifest.xml":
+def first_text(elem, tagname):
+    # text_of(first(findall_anyns(elem, tagname))) without building the list
+    for n in elem.iter(tagname):
+        return (n.text or "").strip()
+    return ""
+
+class QtiDir:
+    # QTI files in an (already extracted) directory
+    def __init__(self, in_dir: Path):
+        self.in_dir = in_dir
+
+    def xml_files(self):
+        # Collect all XML files except imsmanifest.xml
+        xmls = []
+        for p in self.in_dir.rglob("*.xml"):
+            if p.name.lower() != "imsmanifest.xml":
+                xmls.append(p)
+        # Also try files with .xhtml that hold items (rare)
+        for p in self.in_dir.rglob("*.xhtml"):
             xmls.append(p)
-    # Also try files with .xhtml that hold items (rare)
-    for p in in_dir.rglob("*.xhtml"):
-        xmls.append(p)
-    return xmls
-
-def extract_zip_to_tmp(zip_path: Path) -> Path:
-    td = Path(tempfile.mkdtemp(prefix="qti2tex_"))
-    with zipfile.ZipFile(zip_path, "r") as z:
-        z.extractall(td)
-    return td
-
-def get_qti_metadata(item):
+        return sorted(xmls)
+
+    def media_files(self):
+        # map file name -> path of the non-XML assets (images)
+        media = {}
+        for p in self.in_dir.rglob("*"):
+            if p.is_file() and p.suffix.lower() not in (".xml", ".xsd"):
+                media.setdefault(p.name, p)
+        return media
+
+    def open(self, xf):
+        return open(xf, "rb")
+
+    def size(self, xf):
+        return xf.stat().st_size
+
+    def copy_media(self, p, dest: Path):
+        # a real copy, so editing the exam's media never touches the export
+        shutil.copy2(p, dest)
+
+    def close(self):
+        pass
+
+class QtiZip:
+    # QTI files read straight out of the zip, nothing is extracted to disk
+    # except the media that the questions reference
+    def __init__(self, zip_path: Path):
+        self.fp = open(zip_path, "rb")
+        if hasattr(os, "posix_fadvise"):
+            # members are read front to back, let the kernel read ahead
+            os.posix_fadvise(self.fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.zip = zipfile.ZipFile(self.fp, "r")
+
+    def xml_files(self):
+        xmls = []
+        for name in self.zip.namelist():
+            p = PurePosixPath(name)
+            if name.endswith("/"):
+                continue
+            # keep the member name as is, PurePosixPath drops e.g. a leading ./
+            if p.suffix.lower() == ".xml" and p.name.lower() != "imsmanifest.xml":
+                xmls.append(name)
+            elif p.suffix.lower() == ".xhtml":
+                xmls.append(name)
+        return sorted(xmls)
+
+    def media_files(self):
+        media = {}
+        for info in self.zip.infolist():
+            p = PurePosixPath(info.filename)
+            if not info.is_dir() and p.suffix.lower() not in (".xml", ".xsd"):
+                media.setdefault(p.name, info)
+        return media
+
+    def open(self, xf):
+        return self.zip.open(xf)
+
+    def size(self, xf):
+        return self.zip.getinfo(xf).file_size
+
+    def copy_media(self, info, dest: Path):
+        with self.zip.open(info) as src, open(dest, "wb") as dst:
+            # large chunks mean fewer read/write calls for big media files
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+    def close(self):
+        self.zip.close()
+        self.fp.close()
+
+def open_qti(input_file):
+    global qti_source
+    if input_file.lower().endswith(".zip"):
+        qti_source = QtiZip(Path(input_file))
+    else:
+        qti_source = QtiDir(Path(input_file))
+    return qti_source
+
+def read_xml_file(xf):
+    # read_qti_file() for one file of qti_source, None if it isn't valid XML
+    try:
+        with qti_source.open(xf) as fp:
+            return read_qti_file(fp)
+    except ET.ParseError:
+        return None
+
+def get_qti_metadata(idx):
     meta = {}
-    for qtm in findall_anyns(item, "qtimetadatafield"):
-        label = text_of(first(findall_anyns(qtm, "fieldlabel")))
-        val = text_of(first(findall_anyns(qtm, "fieldentry")))
+    for qtm in idx.get("qtimetadatafield", []):
+        # a field only holds its fieldlabel and fieldentry
+        label = val = ""
+        for n in qtm:
+            if n.tag == "fieldlabel":
+                label = (n.text or "").strip()
+            elif n.tag == "fieldentry":
+                val = (n.text or "").strip()
         if label:
             meta[label] = val
     return meta
 
-def get_item_stem(item):
+def get_item_stem(idx):
     # Canvas stores the prompt under presentation/material/mattext (often HTML)
-    pres = first(findall_anyns(item, "presentation"))
+    pres = first(idx.get("presentation"))
     if pres is not None:
-        mats = findall_anyns(pres, "mattext")
-        if mats:
-            return text_of(mats[0])
-        # sometimes material/flow/ material
-        mats2 = findall_anyns(pres, "material")
-        for m in mats2:
-            mt = first(findall_anyns(m, "mattext"))
-            if mt is not None:
-                return text_of(mt)
+        # also finds material/flow/material/mattext
+        for mat in pres.iter("mattext"):
+            return text_of(mat)
     # fallback: item/presentation/flow/p/material/mattext etc.
-    mats = findall_anyns(item, "mattext")
-    return text_of(first(mats))
+    return text_of(first(idx.get("mattext")))
 
 def get_max_choice_len(choices):
     # choices is list of (ident, text)
@@ -113,22 +331,33 @@ def get_max_choice_len(choices):
             maxlen = l
     return maxlen
 
-def get_choices(item):
+if hasattr(ET, "XPath"):
+    # with lxml the correct answer lookup is done by a compiled XPath in C
+    CONDVAR = ".//respcondition/descendant::conditionvar[1]"
+    VAREQUAL_XPATH = ET.XPath(f"{CONDVAR}/varequal | {CONDVAR}/and/varequal | {CONDVAR}/or/varequal")
+else:
+    VAREQUAL_XPATH = None
+
+def get_choices(idx):
     # Return list of (ident, html_text)
     choices = []
-    for rl in findall_anyns(item, "response_lid"):
-        for rc in findall_anyns(rl, "render_choice"):
-            for lbl in findall_anyns(rc, "response_label"):
-                ident = lbl.attrib.get("ident", "")
-                mat = first(findall_anyns(lbl, "mattext"))
-                txt = text_of(mat)
-                choices.append((ident, txt))
+    for rl in idx.get("response_lid", []):
+        for lbl in rl.iterfind(".//render_choice//response_label"):
+            ident = lbl.attrib.get("ident", "")
+            choices.append((ident, first_text(lbl, "mattext")))
     return choices
 
-def get_correct_idents(item):
+def get_correct_idents(idx):
     # Parse resprocessing/respcondition/conditionvar/varequal
     correct = set()
-    for rp in findall_anyns(item, "resprocessing"):
+    if VAREQUAL_XPATH is not None:
+        for rp in idx.get("resprocessing", []):
+            for ve in VAREQUAL_XPATH(rp):
+                ident = (ve.text or "").strip()
+                if ident:
+                    correct.add(ident)
+        return correct
+    for rp in idx.get("resprocessing", []):
         for rc in findall_anyns(rp, "respcondition"):
             condvar = first(findall_anyns(rc, "conditionvar"))
             if condvar is None:
@@ -150,23 +379,23 @@ def get_correct_idents(item):
                         correct.add(ident)
     return correct
 
-def guess_type(meta, item):
+def guess_type(meta, idx):
     # Prefer Canvas metadata when present
     qt = (meta.get("question_type") or meta.get("interaction_type") or "").lower()
     if qt:
         return qt
     # Guess from structure
-    if findall_anyns(item, "response_lid"):
+    if "response_lid" in idx:
         # Could be multiple_choice_question or multiple_answers_question or true_false_question
         # Try to detect T/F by choice labels
-        labels = [t.lower() for _, t in get_choices(item)]
+        labels = [t.lower() for _, t in get_choices(idx)]
         if set(labels) & {"true", "false"} and len(labels) <= 3:
             return "true_false_question"
         # multi-answer if more than one correct
-        if len(get_correct_idents(item)) > 1:
+        if len(get_correct_idents(idx)) > 1:
             return "multiple_answers_question"
         return "multiple_choice_question"
-    if findall_anyns(item, "response_str"):
+    if "response_str" in idx:
         # short answer / numeric
         return "short_answer_question"
     # fallback
@@ -207,7 +436,7 @@ def write_exam_header(f, title, description, mainfont, version=""):
 def write_exam_footer(f):
     f.write(r"\end{questions}" "\n" r"\numpoints\ total points  \numbonuspoints\ bonus points" "\n" r"\end{document}" "\n")
 
-def render_question_latex(qtype, stem_html, item, points):
+def render_question_latex(qtype, stem_html, question, points):
     stem = html_to_latex(stem_html)
     # Replace bold-italic underscores (text2qti fill-in-the-blank markers) with \fillin
     stem = re.sub(r"\\textbf\{\\emph\{(\\_)+\}\}", r"\\fillin[\\hspace{1.5in}]", stem)
@@ -230,12 +459,12 @@ def render_question_latex(qtype, stem_html, item, points):
     else:
         lines = ["\\filbreak\n", f"\\question[{points}] {stem}\n"]
 
-    correct = get_correct_idents(item)
+    correct = question["correct"]
 
     if qtype in ("multiple_choice_question", "true_false_question"):
         lines.append("{\n")
         lines.append("\\begin{samepage}\n")
-        choices1 = get_choices(item)
+        choices1 = question["choices"]
         maxlen = get_max_choice_len(choices1)
         if maxlen <= 20:
             onepar = "onepar"
@@ -256,7 +485,7 @@ def render_question_latex(qtype, stem_html, item, points):
         lines.append("{\n")
         lines.append("\\begin{samepage}\n")
         lines.append("\\checkboxchar{$\\square$}\n")
-        choices = get_choices(item)
+        choices = question["choices"]
         maxlen = get_max_choice_len(choices)
         if maxlen <= 20:
             onepar = "onepar"
@@ -289,11 +518,10 @@ def render_question_latex(qtype, stem_html, item, points):
             lines.append(" / ".join(html_to_latex(c) for c in correct))
             lines.append("\n\\end{solution}\n")
         else:
-            feedback = findall_anyns(item, "itemfeedback")
+            feedback = question["feedback"]
             if feedback:
                 lines.append("\\begin{solution}\n")
-                for fb in feedback:
-                    fbtext = text_of(first(findall_anyns(fb, "mattext")))
+                for fbtext in feedback:
                     if fbtext:
                         lines.append(html_to_latex(fbtext) + "\n")
                 lines.append("\\end{solution}\n")
@@ -311,26 +539,89 @@ def render_question_latex(qtype, stem_html, item, points):
 
 
 def extract_tag(element):
-    return element.tag.split('}')[-1]
-
-
-def get_group(question):
-    items = []
+    local = LOCALNAMES.get(element.tag)
+    if local is None:
+        local = LOCALNAMES[element.tag] = element.tag.rpartition('}')[2]
+    return local
+
+
+def read_qti_file(fp):
+    # Stream the file, keeping only the title/description and the questions of
+    # assessment/section. Returns (title, description, entries) where entries
+    # are ("item", question) or ("section", selection_count, points, questions).
+    # Items and the elements around them are cleared as soon as they have been
+    # read, so memory stays at about one item.
+    title = None
+    description = None
+    entries = []
+    group_items = []
     selection_count = None
     points = None
-    for n in question:
-        if extract_tag(n) == "item":
-            items.append(n)
-        elif extract_tag(n) == "selection_ordering":
-            selection_count = int(findall_anyns(n, "selection_number")[0].text)
-            points = int(findall_anyns(n, "points_per_item")[0].text)
-    return selection_count, points, items
+    done = False
+    path = []
+    item_idx = None
+    for event, elem in ET.iterparse(fp, events=("start", "end"), **XML_PARSER_OPTIONS):
+        if event == "start":
+            # drop the namespace once, see findall_anyns
+            tag = elem.tag = extract_tag(elem)
+            path.append(tag)
+            if tag == "item":
+                item_idx = {}
+            elif item_idx is not None and tag in ITEM_INDEX_TAGS:
+                item_idx.setdefault(tag, []).append(elem)
+            continue
+        tag = path.pop()
+        if item_idx is not None and tag != "item":
+            # part of an item, it is read when the item ends
+            continue
+        # path is now root/.../parent, depth counts the parents below the root
+        depth = len(path) - 1
+        if depth <= 0:
+            if tag == "title" and title is None:
+                title = text_of(elem)
+            elif tag == "description" and description is None:
+                description = text_of(elem)
+        elif done or path[1] != "assessment":
+            pass
+        elif depth == 1:
+            # only the first section of the first assessment is used
+            done = tag == "section"
+        elif path[2] != "section":
+            pass
+        elif tag == "item" and depth <= 3:
+            question = read_question(elem, item_idx)
+            if depth == 2:
+                entries.append(("item", question))
+            else:
+                group_items.append(question)
+        elif tag == "selection_ordering" and depth == 3:
+            selection_count = int(findall_anyns(elem, "selection_number")[0].text)
+            points = int(findall_anyns(elem, "points_per_item")[0].text)
+        elif depth == 2:
+            if tag == "section":
+                entries.append(("section", selection_count, points, group_items))
+                group_items = []
+                selection_count = None
+                points = None
+            else:
+                print(f"what is {elem}")
+        item_idx = None
+        if tag != "item" and tag != "selection_ordering" and depth > 2:
+            # may still be needed by an enclosing element
+            continue
+        elem.clear()
+        if hasattr(elem, "getprevious"):
+            # lxml keeps the cleared siblings alive in the parent, drop them
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    return title, description, entries
 
 
 def get_qti_metadata_field(question, param):
+    # question must be an item from read_qti_file (namespace-stripped tags)
     for qtm in findall_anyns(question, "qtimetadatafield"):
-        label = text_of(first(findall_anyns(qtm, "fieldlabel")))
-        val = text_of(first(findall_anyns(qtm, "fieldentry")))
+        label = first_text(qtm, "fieldlabel")
+        val = first_text(qtm, "fieldentry")
         if label == param:
             return val
 
@@ -348,12 +639,7 @@ def main(input_file, output, essay_vspace, mainfont, answer_key, choose_item):
     global essay_vspace_lines
     global make_answer_key
     essay_vspace_lines = essay_vspace
-    tmp_dir = None
-    if input_file.lower().endswith(".zip"):
-        tmp_dir = extract_zip_to_tmp(Path(input_file))
-        in_dir = tmp_dir
-    else:
-        in_dir = Path(input_file)
+    qti = open_qti(input_file)
 
     if not output:
         output = Path(input_file).stem + (f'-{choose_item}' if choose_item else '') + ".tex"
@@ -365,81 +651,92 @@ def main(input_file, output, essay_vspace, mainfont, answer_key, choose_item):
         make_answer_key = True
 
     # collect XML item containers
-    xml_files = read_qti_dir(in_dir)
+    xml_files = qti.xml_files()
     if not xml_files:
         raise SystemExit("No QTI XML files found.")
 
-    # Copy any non-XML assets (images) into a 'media' folder next to the .tex
-    out_media = Path("media")
-    if not out_media.exists():
-        out_media.mkdir(parents=True, exist_ok=True)
-    for p in in_dir.rglob("*"):
-        if p.is_file() and p.suffix.lower() not in (".xml", ".xsd"):
-            # keep relative name
-            dest = out_media / p.name
-            if not dest.exists():
-                try:
-                    shutil.copy2(p, dest)
-                except Exception:
-                    pass  # best effort
+    # Find the non-XML assets (images), only the referenced ones get copied
+    media_files = qti.media_files()
+
+    # parse each file once, in parallel when there is enough XML to pay for
+    # the worker processes
+    workers = min(len(xml_files), os.cpu_count() or 1)
+    if workers > 1 and sum(qti.size(xf) for xf in xml_files) > PARALLEL_PARSE_BYTES:
+        with ProcessPoolExecutor(workers, initializer=open_qti, initargs=(input_file,)) as ex:
+            results = list(ex.map(read_xml_file, xml_files))
+    else:
+        results = [read_xml_file(xf) for xf in xml_files]
 
+    # find the title/description and collect every HTML fragment so that
+    # pandoc only has to run once
     description = ''
-    for xf in sorted(xml_files):
-        try:
-            tree = ET.parse(xf)
-        except ET.ParseError:
+    entries = []
+    latex_batcher.collecting = True
+    for result in results:
+        if result is None:
             continue
-        root = tree.getroot()
-        title_element = child_anyns(root, "title")
-        if title_element is not None:
-            title = text_of(title_element)
-        description_element = child_anyns(root, "description")
-        if description_element is not None:
-            description = html_to_latex(text_of(description_element))
-
-
-    # parse and write latex
-    with open(output, "w", encoding="utf-8") as f:
-        version = "$_{" + chr(ord('a') + (choose_item*17)%25) + "}$" if choose_item else ""
-        write_exam_header(f, title, description, mainfont, version)
-
-        for xf in sorted(xml_files):
-            try:
-                tree = ET.parse(xf)
-            except ET.ParseError:
-                continue
-            root = tree.getroot()
-            assessement = child_anyns(root, "assessment")
-            if assessement is None:
-                continue
-            questions = child_anyns(assessement, "section")
-            if questions is None:
-                continue
-            for question in questions:
-                if extract_tag(question) == "item":
-                    write_question(f, question)
-                elif extract_tag(question) == "section":
-                    selection_count, points, items = get_group(question)
-                    if make_answer_key:
-                        count = len(items)
-                    else:
-                        if choose_item == 0:
-                            random.shuffle(items)
-                        else:
-                            item_index = (choose_item - 1) % len(items)
-                            items = items[item_index:] + items[:item_index]
-                        count = selection_count
-                    for i in range(count):
-                        if i >= selection_count:
-                            f.write("\\addtocounter{question}{-1}\n")
-                        write_question(f, items.pop(0), points)
-
+        file_title, file_description, file_entries = result
+        if file_title is not None:
+            title = file_title
+        if file_description is not None:
+            description = file_description
+            html_to_latex(description)
+        for entry in file_entries:
+            if entry[0] == "item":
+                queue_question(entry[1])
+            else:
+                for question in entry[3]:
+                    queue_question(question)
+        entries.extend(file_entries)
+    latex_batcher.convert()
+    if description:
+        description = html_to_latex(description)
+
+    # build the latex in memory and write it out in one go
+    f = io.StringIO()
+    version = "$_{" + chr(ord('a') + (choose_item*17)%25) + "}$" if choose_item else ""
+    write_exam_header(f, title, description, mainfont, version)
+
+    for entry in entries:
+        if entry[0] == "item":
+            write_question(f, entry[1])
+        else:
+            _, selection_count, points, items = entry
+            if make_answer_key:
+                count = len(items)
+            else:
+                if choose_item == 0:
+                    random.shuffle(items)
                 else:
-                    print(f"what is {question}")
-        write_exam_footer(f)
+                    item_index = (choose_item - 1) % len(items)
+                    items = items[item_index:] + items[:item_index]
+                count = selection_count
+            for i in range(count):
+                if i >= selection_count:
+                    f.write("\\addtocounter{question}{-1}\n")
+                write_question(f, items.pop(0), points)
+    write_exam_footer(f)
+    Path(output).write_text(f.getvalue(), encoding="utf-8")
+
+    # Copy the referenced assets into a 'media' folder next to the .tex
+    out_media = Path("media")
+    if not out_media.exists():
+        out_media.mkdir(parents=True, exist_ok=True)
+        existing = set()
+    else:
+        # files from an earlier run are kept, list them once instead of a stat per file
+        existing = {p.name for p in out_media.iterdir()}
+    for name in sorted(referenced_media):
+        p = media_files.get(name)
+        if p is None or name in existing:
+            continue
+        dest = out_media / name
+        try:
+            qti.copy_media(p, dest)
+        except Exception:
+            pass  # best effort
 
-    if tmp_dir:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+    qti.close()
 
     print(f"Wrote {output}.")
     print("Note: image files copied (best-effort) to ./media/. Compile with:")
@@ -447,14 +744,48 @@ def main(input_file, output, essay_vspace, mainfont, answer_key, choose_item):
 
 
 def write_question(f, question, points = None):
-    meta = get_qti_metadata(question)
     if points is None:
-        points = int(meta.get("points_possible"))
-    qtype = guess_type(meta, question)
-    stem = get_item_stem(question)
+        points = int(question["points"])
+    f.write(render_question_latex(question["qtype"], question["stem"], question, points))
+
+
+def read_question(item, idx):
+    # Pull everything needed to render the item out of its element and its
+    # index (localname -> elements, see ITEM_INDEX_TAGS), so the element can
+    # be discarded while parsing
+    meta = get_qti_metadata(idx)
+    question = {
+        "points": meta.get("points_possible"),
+        "qtype": guess_type(meta, idx),
+        "stem": get_item_stem(idx),
+        "choices": get_choices(idx),
+        "correct": get_correct_idents(idx),
+        "feedback": [first_text(fb, "mattext") for fb in idx.get("itemfeedback", [])],
+    }
+    return question
+
+
+def queue_question(question):
+    # rewrite the stem's media references and queue the question's HTML for
+    # the batched pandoc conversion
+    question["stem"] = rewrite_media(question["stem"])
+    render_question_latex(question["qtype"], question["stem"], question, 0)
+
+
+SRC_RE = re.compile(r'src=["\']([^"\']+)["\']')
+
+def rewrite_src(m):
+    # point the src at media/filename and remember to copy the file, Canvas
+    # URL-encodes the src and may add a query string to it
+    src = m.group(1)
+    referenced_media.add(PurePosixPath(unquote(urlsplit(src).path)).name)
+    return f'src="media/{Path(src).name}"'
+
+def rewrite_media(stem):
     # rewrite any <img src="..."> to media/filename
-    stem = re.sub(r'src=["\']([^"\']+)["\']', lambda m: f'src="media/{Path(m.group(1)).name}"', stem)
-    f.write(render_question_latex(qtype, stem, question, points))
+    if "src=" in stem:
+        stem = SRC_RE.sub(rewrite_src, stem)
+    return stem
 
 
 if __name__ == "__main__":